@@ -1,8 +1,10 @@
+import os
 import timeit
 import functools
 
 import rsa
 import prime
+from utils import modinv
 
 PRP = 0x13c6ff366eb6f235cccce9bc3a4f8a2f0f36360219ac9e9b6bd3b59c439c45bfa8b33ceaa369adf26603fc6df524ae1216d61d8bad6b08af31d50bb310cac456ff2264a06f60898d66a61bcc4012e9e0b9d8a7dd70412513dbd7cbea4b85aede5a8ee94012657eb2686c5bf92d8cd089c3de49ccc5b25e75de326357449d9df31
 JUNK = (b'.bNMl89:..YPF&+/:lmqCGH.AZMR"?[SI_S^>Z%1M9co!EZJb#!+2M{0J[:YV#%.#?E!-=%6Ux5Y'
@@ -20,12 +22,14 @@ JUNK = (b'.bNMl89:..YPF&+/:lmqCGH.AZMR"?[SI_S^>Z%1M9co!EZJb#!+2M{0J[:YV#%.#?E!-=
         b'k1/N7_W7.TVN4gF`K4]P?|6DDgRYW$?#L1ILnR0E`fit%FE4FJ$a@F"Rr|6bbJfMZ.0_Qd#ymRG-'
         b'e6kYvC%EPdYAy9MaM.1|]Q|_HiG>:WD&xbIT')
 
+PROFILE = os.getenv('PROFILE', prime.DEFAULT_PROFILE)
+
 def prow(*row):
     print(' %-23s | %s' % row)
 
 def keygen(bits=1024):
     global key
-    key = rsa.RSAKey(bits=bits, e=PRP)
+    key = rsa.RSAKey(bits=bits, e=PRP, profile=PROFILE)
 
 def enc():
     global e
@@ -35,6 +39,7 @@ def dec(useCRT=True):
     k = key if useCRT else key.simplify()
     rsa.RSA(k).decrypt_data(e)
 
+print('primality profile: %s' % PROFILE)
 prow('Title', 'Time')
 print('-' * 24 + '-+-' + '-' * 24)
 
@@ -67,3 +72,8 @@ prow(
     'decrypt data (no CRT)',
     timeit.timeit(functools.partial(dec, False), number=50)
 )
+
+prow(
+    'd bits (phi / lambda)',
+    '%d / %d' % (modinv(key.e, key.phi).bit_length(), key.d.bit_length())
+)
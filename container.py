@@ -0,0 +1,123 @@
+"""
+indexed ciphertext container
+
+    header      magic, version, key fingerprint, block size, plaintext length,
+                block count, index offset
+    blocks      encrypted blocks, each holds (block size - 1) bytes plaintext
+    index       offset of every block, relative to start of container
+
+all integers are little-endian
+"""
+
+import collections
+import struct
+
+from rsa import iter_blocks, write_stream
+
+MAGIC = b'RSAC'
+VERSION = 1
+HEADER = struct.Struct('<4sB3x16sIQQQ')
+INDEX = struct.Struct('<Q')
+
+Header = collections.namedtuple('Header', ['fingerprint', 'block_size', 'length', 'count', 'index_offset'])
+
+def write(cipher, source, dest, workers=None):
+    """
+    encrypt readable binary file or iterator of bytes into container
+
+    dest must be a seekable binary file, header is filled after all blocks
+    are written. return the header
+    """
+    base = dest.tell()
+    dest.write(b'\x00' * HEADER.size)
+
+    bs = cipher.key.block_size
+    length = [0]
+    def count(blocks):
+        for block in blocks:
+            length[0] += len(block)
+            yield block
+
+    blocks = count(iter_blocks(source, bs - 1))
+    n = write_stream(dest, cipher._map_blocks('encrypt_block', blocks, workers)) // bs
+
+    index_offset = HEADER.size + n * bs
+    for i in range(n):
+        dest.write(INDEX.pack(HEADER.size + i * bs))
+
+    header = Header(cipher.key.fingerprint()[:16], bs, length[0], n, index_offset)
+    end = dest.tell()
+    dest.seek(base)
+    dest.write(HEADER.pack(MAGIC, VERSION, *header))
+    dest.seek(end)
+    return header
+
+def read_header(f, cipher=None):
+    """
+    read header at current position of f, check key fingerprint if cipher
+    is given
+    """
+    data = f.read(HEADER.size)
+    if len(data) != HEADER.size:
+        raise ValueError('truncated RSA container header')
+    magic, version, fingerprint, bs, length, count, index_offset = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ValueError('not a RSA container')
+    if version != VERSION:
+        raise ValueError('unsupported container version %d' % version)
+    if cipher and cipher.key.fingerprint()[:16] != fingerprint:
+        raise ValueError('container was encrypted with another key')
+    if cipher and cipher.key.block_size != bs:
+        raise ValueError('block size mismatch')
+    return Header(fingerprint, bs, length, count, index_offset)
+
+def read(cipher, source, dest, workers=None):
+    """
+    decrypt container from seekable binary file source to dest, return
+    bytes written
+    """
+    base = source.tell()
+    header = read_header(source, cipher)
+    bs = header.block_size
+
+    def blocks():
+        for i in range(header.count):
+            source.seek(base + _offset(source, base, header, i))
+            yield source.read(bs)
+
+    remain = header.length
+    n = 0
+    for block in cipher._map_blocks('decrypt_block', blocks(), workers):
+        data = block[:remain]
+        dest.write(data)
+        remain -= len(data)
+        n += len(data)
+    return n
+
+def read_range(cipher, f, start, stop):
+    """
+    decrypt plaintext bytes [start, stop) of container in seekable binary
+    file f, only blocks covering the range are read and decrypted
+    """
+    if start < 0:
+        raise ValueError('start must not be negative')
+    base = f.tell()
+    header = read_header(f, cipher)
+    stop = min(stop, header.length)
+    if start >= stop:
+        return b''
+
+    pbs = header.block_size - 1
+    first, last = start // pbs, (stop - 1) // pbs
+    f.seek(base + header.index_offset + first * INDEX.size)
+    offsets = struct.unpack('<%dQ' % (last - first + 1), f.read((last - first + 1) * INDEX.size))
+
+    data = []
+    for offset in offsets:
+        f.seek(base + offset)
+        data.append(cipher.decrypt_block(f.read(header.block_size)))
+    return b''.join(data)[start - first * pbs:stop - first * pbs]
+
+def _offset(f, base, header, i):
+    f.seek(base + header.index_offset + i * INDEX.size)
+    return INDEX.unpack(f.read(INDEX.size))[0]
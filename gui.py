@@ -1,6 +1,7 @@
 from tk import *
 from rsa import *
 from utils import *
+import keypool
 import sys
 
 sys.path.insert(0, './pygubu')
@@ -16,7 +17,7 @@ class App(object):
         self.keystatus = builder.get_object('txtKeystatus')
         self.datatxt = builder.get_object('txtData')
 
-        self.setkey(RSAKey(bits=768))
+        self.setkey(RSAKey.from_pool(768))
 
         builder.connect_callbacks({
             k: getattr(self, k) for k in dir(self) if k[0] != '_'
@@ -62,7 +63,7 @@ class App(object):
     def loadkey(self):
         try:
             with filedialog.askopenfile('r') as fin:
-                self.setkey(RSAKey.from_json(fin.read()))
+                self.setkey(RSAKey.from_json(fin.read(), factor=True))
                 messagebox.showinfo('Key Loaded', 'RSA Keypair loaded from %s' % fin.name)
         except:
             messagebox.showwarning('File Loading Error', 'Can not load file')
@@ -110,5 +111,8 @@ class App(object):
 if __name__ == '__main__':
     root = tkinter.Tk()
     root.title('RSA Tool')
-    app = App(root)
-    root.mainloop()
+    try:
+        app = App(root)
+        root.mainloop()
+    finally:
+        keypool.shutdown()
@@ -0,0 +1,109 @@
+import hashlib
+import logging
+import os
+
+import randomness
+import rsa
+from utils import *
+
+logger = logging.getLogger('keycache')
+
+DEFAULT_CACHE = os.getenv('RSA_KEYCACHE', os.path.join(os.path.expanduser('~'), '.rsa-keycache'))
+DEFAULT_MAX_SIZE = 16 << 20
+
+# bump when key generation changes, keys derived by older versions are not reused
+VERSION = 2
+
+def derive_material(seed, bits, e=0x10001):
+    """
+    bytes which seed the random source of a derived key, seed is an integer,
+    str or bytes, the type is tagged so 10 and 'a' give different keys
+    """
+    if type(seed) in IntTypes:
+        seed = 'int/%x' % seed
+    else:
+        seed = b'bytes/' + ensure_bytes(seed)
+    return ensure_bytes('rsa-derive/%d/%d/%x/' % (VERSION, bits, e)) + ensure_bytes(seed)
+
+def generate(seed, bits, e=0x10001):
+    """
+    generate key from (seed, bits, e) with a HashDRBG, same input gives the same
+    key on every run
+    """
+    with randomness.using(randomness.HashDRBG(derive_material(seed, bits, e))):
+        return rsa.RSAKey(bits=bits, e=e)
+
+class KeyCache(object):
+    """
+    derived keys stored as JSON files in cache directory, named by SHA-256 of
+    derivation input, least recently used keys are removed when total size
+    exceeds `max_size` bytes
+    """
+
+    def __init__(self, path=DEFAULT_CACHE, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.max_size = max_size
+        private_dir(path)
+
+    def filename(self, seed, bits, e=0x10001):
+        name = hashlib.sha256(derive_material(seed, bits, e)).hexdigest()
+        return os.path.join(self.path, name + '.json')
+
+    def derive(self, seed, bits, e=0x10001):
+        """
+        derived key of (seed, bits, e), from cache if it was derived before
+        """
+        filename = self.filename(seed, bits, e)
+        try:
+            with open(filename, 'r') as f:
+                key_json = f.read()
+            os.utime(filename, None) # mark as recently used
+            return rsa.RSAKey.from_json(key_json)
+        except (IOError, OSError, ValueError):
+            pass
+
+        logger.info('deriving %d bits key', bits)
+        key = generate(seed, bits, e)
+        atomic_write(filename, key.to_json())
+        self.evict()
+        return key
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(self.path, name)) for name in os.listdir(self.path) if name.endswith('.json'))
+
+    def evict(self):
+        """
+        remove least recently used keys until total size fits in max_size
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.json'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError: # removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.path, name))
+
+_default_cache = None
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = KeyCache()
+    return _default_cache
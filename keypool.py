@@ -0,0 +1,137 @@
+import logging
+import multiprocessing
+import os
+import threading
+
+import randomness
+import rsa
+from utils import *
+
+logger = logging.getLogger('keypool')
+
+DEFAULT_SPOOL = os.getenv('RSA_KEYPOOL', os.path.join(os.path.expanduser('~'), '.rsa-keypool'))
+
+def _generate(args):
+    """
+    process pool task, returns JSON of a new key, or None if it failed
+    """
+    bits, e, source = args
+    randomness.set_source(source)
+    try:
+        return rsa.RSAKey(bits=bits, e=e).to_json()
+    except Exception:
+        logger.exception('generating %d bits key failed', bits)
+        return None
+
+class KeyPool(object):
+    """
+    pre-generated keys stored as JSON files in spool/<bits>-<e>/
+
+    when stock of a key size drops below `low`, background workers generate
+    keys until there are `high` of them
+    """
+
+    def __init__(self, spool=DEFAULT_SPOOL, low=2, high=8, workers=1):
+        assert 0 <= low <= high, 'low watermark must not exceed high watermark'
+        self.spool = spool
+        self.low = low
+        self.high = high
+        self.workers = workers
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.pool = None
+
+    def path(self, bits, e=0x10001):
+        private_dir(self.spool) # keys are private keys
+        return private_dir(os.path.join(self.spool, '%d-%x' % (bits, e)))
+
+    def stock(self, bits, e=0x10001):
+        """
+        number of keys ready in spool directory
+        """
+        return sum(1 for name in os.listdir(self.path(bits, e)) if name.endswith('.json'))
+
+    def take(self, bits, e=0x10001):
+        """
+        take a key out of the pool, return None if the pool is empty
+        """
+        path = self.path(bits, e)
+        key = None
+        for name in os.listdir(path):
+            if not name.endswith('.json'):
+                continue
+            filename = os.path.join(path, name)
+            claimed = filename + '.taken'
+            try:
+                os.rename(filename, claimed) # other process may take it first
+            except OSError:
+                continue
+            with open(claimed, 'r') as f:
+                key = rsa.RSAKey.from_json(f.read())
+            os.remove(claimed)
+            break
+
+        self.refill(bits, e)
+        return key
+
+    def refill(self, bits, e=0x10001):
+        """
+        start generating keys in background if stock is below low watermark
+        """
+        with self.lock:
+            stock = self.stock(bits, e) + self.pending.get((bits, e), 0)
+            if stock >= self.low:
+                return
+            n = self.high - stock
+            self.pending[(bits, e)] = self.pending.get((bits, e), 0) + n
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(self.workers)
+
+        logger.info('refilling %d keys of %d bits', n, bits)
+        store = lambda key_json: self.store(bits, e, key_json)
+        for i in range(n):
+            self.pool.apply_async(_generate, ((bits, e, randomness.split()), ), callback=store)
+
+    def store(self, bits, e, key_json):
+        """
+        persist a generated key to spool directory, key_json is None when
+        generation failed, the key is no longer pending either way
+        """
+        try:
+            if key_json is not None:
+                name = ensure_str(enhex(os.urandom(8))) + '.json'
+                atomic_write(os.path.join(self.path(bits, e), name), key_json)
+        finally:
+            with self.lock:
+                self.pending[(bits, e)] -= 1
+
+    def close(self, wait=True):
+        """
+        stop background workers, wait for pending keys to be stored if `wait`
+        """
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is None:
+            return
+        if wait:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+        with self.lock:
+            self.pending.clear()
+
+_default_pool = None
+
+def default_pool():
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = KeyPool()
+    return _default_pool
+
+def shutdown(wait=False):
+    """
+    stop background workers of default pool if it was used, call at exit
+    """
+    if _default_pool is not None:
+        _default_pool.close(wait)
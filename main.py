@@ -1,9 +1,11 @@
 import cmd
 import logging
 import os
+import shlex
 import sys
 
 from rsa import RSA, RSAKey
+import keypool
 import prime
 from utils import *
 
@@ -22,10 +24,15 @@ class InteractiveShell(cmd.Cmd):
         cmd.Cmd.__init__(self)
 
         self.config = {
-            "e": '65537'
+            "e": '65537',
+            "workers": '1',
+            "nprimes": '2',
+            "primality": 'mr',
+            "profile": prime.DEFAULT_PROFILE,
+            "timeout": '0'
         }
 
-        key = RSAKey(bits=1024, e=int(self.config['e']))
+        key = RSAKey.from_pool(1024, int(self.config['e']))
         print('Default key generated (1024 bits)')
         self.setkey(key)
         self.last = None
@@ -58,7 +65,12 @@ class InteractiveShell(cmd.Cmd):
         set key val
 
         available key:
-            e   public exponent
+            e           public exponent
+            workers     processes used by keygen, enc and dec
+            nprimes     number of primes of generated key
+            primality   primality test, mr, bpsw or provable
+            profile     Miller-Rabin error target, fast, fips186 or paranoid
+            timeout     seconds keygen may take, 0 for no limit
         """
 
         try:
@@ -77,7 +89,12 @@ class InteractiveShell(cmd.Cmd):
         get key
 
         available key:
-            e   public exponent
+            e           public exponent
+            workers     processes used by keygen, enc and dec
+            nprimes     number of primes of generated key
+            primality   primality test, mr, bpsw or provable
+            profile     Miller-Rabin error target, fast, fips186 or paranoid
+            timeout     seconds keygen may take, 0 for no limit
         """
 
         if not key:
@@ -89,13 +106,15 @@ class InteractiveShell(cmd.Cmd):
     def complete_enc(self, *args):
         return self.complete_filename(*args)
 
-    def do_enc(self, file):
+    def do_enc(self, line):
         """
         enc [file]
 
         keep file empty to read data form stdin
         """
 
+        file = line
+
         if not file:
             data = input('Data to encrypt:')
         else:
@@ -105,22 +124,69 @@ class InteractiveShell(cmd.Cmd):
                 print('Can not open file %r' % file)
                 return
 
-        c = self.cipher.encrypt_data(data)
+        c = self.cipher.encrypt_data(data, int(self.config['workers']))
         self.last = c
 
         print('Source data: %r...' % data[:256])
         print('Encrypted: %r...' % enhex(c[:256]))
 
+    def do_encfile(self, line):
+        """
+        encfile file output
+
+        encrypt file to output block by block, quote names with spaces
+        """
+        self.stream(self.cipher.encrypt_file, line)
+
+    def complete_encfile(self, *args):
+        return self.complete_filename(*args)
+
+    def do_decfile(self, line):
+        """
+        decfile file output
+
+        decrypt file to output block by block, quote names with spaces
+        """
+        self.stream(self.cipher.decrypt_file, line)
+
+    def complete_decfile(self, *args):
+        return self.complete_filename(*args)
+
+    def stream(self, f, line):
+        try:
+            file, output = shlex.split(line)
+        except ValueError:
+            print('input and output file are required')
+            return
+
+        try:
+            fin = open(file, 'rb')
+        except:
+            print('Can not open file %r' % file)
+            return
+
+        try:
+            with fin, open(output, 'wb') as fout:
+                t, n = profile(lambda: f(fin, fout, int(self.config['workers'])))
+        except IOError:
+            print('Can not write file %r' % output)
+            return
+
+        print('%g ms used' % (t * 1000))
+        print('%d bytes written to %s' % (n, output))
+
     def complete_dec(self, *args):
         return self.complete_filename(*args)
 
-    def do_dec(self, file):
+    def do_dec(self, line):
         """
         dec [file]
 
         keep file empty to read data from stdin
         """
 
+        file = line
+
         if not file:
             data = input('Data to decrypt in hex:')
             try:
@@ -135,7 +201,7 @@ class InteractiveShell(cmd.Cmd):
                 print('Can not open file %r' % file)
                 return
 
-        t, m = profile(lambda: self.cipher.decrypt_data(data))
+        t, m = profile(lambda: self.cipher.decrypt_data(data, int(self.config['workers'])))
         self.last = m
 
         print('%g ms used' % (t * 1000))
@@ -158,11 +224,20 @@ class InteractiveShell(cmd.Cmd):
             print('You are generating long RSA keypair, it may take some while.')
             print('Interrupt by Ctrl-C')
 
+        def progress(p):
+            eta = '%.1fs' % p.eta if p.eta is not None else '?'
+            print('%d candidates, %d rounds, %.1fs elapsed, eta %s' % (p.candidates, p.rounds, p.elapsed, eta))
+
+        token = prime.CancelToken(float(self.config['timeout']), progress, 1)
         try:
-            key = RSAKey(bits=bits, e=int(self.config['e']))
+            key = RSAKey(bits=bits, e=int(self.config['e']), workers=int(self.config['workers']),
+                         nprimes=int(self.config['nprimes']), primality=self.config['primality'],
+                         profile=self.config['profile'], token=token)
             self.setkey(key)
         except ValueError:
             print('Can not generate key')
+        except prime.DeadlineExceeded:
+            print('Timeout, no key generated in %s seconds' % self.config['timeout'])
         except KeyboardInterrupt:
             print('Canceld')
 
@@ -176,14 +251,23 @@ class InteractiveShell(cmd.Cmd):
 
         self.setkey(self.key.simplify())
 
-    def do_prime(self, bits):
+    def do_prime(self, line):
         """
-        prime bits
+        prime bits [safe|strong]
 
         generate a prime with n-bits length
+            safe    safe prime p = 2q + 1 (q is prime) of exactly n bits
+            strong  Gordon's strong prime of exactly n bits
         """
 
-        print(prime.randprime_bits(int(bits)))
+        bits, _, kind = line.partition(' ')
+        if kind == 'safe':
+            print(prime.randprime_safe(int(bits)))
+        elif kind == 'strong':
+            print(prime.randprime_strong(int(bits)))
+        else:
+            rounds = prime.mr_rounds(int(bits) + 1, self.config['profile'])
+            print(prime.randprime_bits(int(bits), self.config['primality'], None, rounds))
 
     def do_dump(self, file):
         """
@@ -237,7 +321,7 @@ class InteractiveShell(cmd.Cmd):
             json_data = input('Input JSON-format key:')
 
         try:
-            key = RSAKey.from_json(json_data)
+            key = RSAKey.from_json(json_data, factor=True)
         except Exception as e:
             print('Can not load key, Error show below:')
             print(e)
@@ -286,4 +370,8 @@ class InteractiveShell(cmd.Cmd):
             print(self.cipher.key.as_dict())
             self.key.dump()
 
-InteractiveShell().cmdloop()
+if __name__ == '__main__':
+    try:
+        InteractiveShell().cmdloop()
+    finally:
+        keypool.shutdown()
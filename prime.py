@@ -1,37 +1,33 @@
+import collections
 import itertools
 import logging
 import math
+import mmap
 import os
-import random
+import randomness
+import struct
 import sys
+import time
 import timeit
 import utils
 
+try: # optional, vectorized sieving
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger('prime')
 
-KNOWN_PRIME = [2, 3, 5, 7, 11]
+SEGMENT_SIZE = 1 << 16
+BATCH_SIZE = 64
+BATCH_MIN_BITS = 384 # below this a Miller-Rabin round is cheaper than batch filtering
+NUMPY_SIEVE_LIMIT = 1 << 20 # sieve candidates with primes below this with numpy
 
-SEED, GENERATOR, RMAX, STATE = 0x28d2c378a13f7985f, 0x2404894e07c9c9fb72524198122d966b81584bcf517f9ac3bca80b1e3b4991e11, 0x2f2191d53fd937c2716bb869cfac40240e3042f21d6ca1cf9f09498a496fe7983, None
-def randinit():
-    global STATE
-    STATE = ((SEED * GENERATOR) ^ 0x245c7bfcc07aff5df56a6c354c6b527e92daf65b06bfb34e1e50e2c1444a48943) % RMAX
+if os.getenv('NONUMPY', False):
+    numpy = None
 
-def _randrange(a, b):
-    global STATE
-    if STATE == None:
-        randinit()
-    r = b - a
-    s = 0
-    while s < r:
-        STATE = ((STATE * GENERATOR) ^ SEED) % RMAX
-        s = (s * 103 + STATE) ^ s >> 3
-    return b + s % r
-
-if os.getenv('NONRANDOM', False):
-    print('[*] Non-random mode enabled')
-    randrange = _randrange
-else:
-    randrange = random.randrange
+def randrange(a, b):
+    return randomness.randrange(a, b)
 
 def binsearch(x, arr):
     l, r = 0, len(arr) - 1
@@ -48,97 +44,835 @@ def binsearch(x, arr):
 
     return False
 
-def prime_generator():
-    for p in KNOWN_PRIME:
-        yield p
-    n = KNOWN_PRIME[-1] - KNOWN_PRIME[-1] % 6
+def sieve(n):
+    """
+    sieve of Eratosthenes, return bytearray f of length n, f[x] is 1 if x is prime
+    """
+    f = bytearray([1]) * n
+    f[:2] = bytearray(min(n, 2))
+    for i in range(2, utils.isqrt(max(n - 1, 0)) + 1):
+        if f[i]:
+            f[i*i::i] = bytearray((n - 1 - i*i) // i + 1)
+    return f
 
-    def test(x):
-        if x <= KNOWN_PRIME[-1]:
-            return binsearch(x, KNOWN_PRIME)
+def primes_below(n):
+    """
+    list of primes less than n
+    """
+    if n <= len(SMALL_SIEVE):
+        return list(itertools.compress(itertools.count(), SMALL_SIEVE[:n]))
+    if numpy is not None:
+        return _np_primes_below(n).tolist()
+    return list(primes_in_range(2, n))
 
-        for p in KNOWN_PRIME:
-            if x % p == 0:
-                return False
+def primes_in_range(a, b, segment=SEGMENT_SIZE):
+    """
+    yield primes in [a, b) with segmented sieve of Eratosthenes
 
-        KNOWN_PRIME.append(x)
-        return True
+    only primes below sqrt(b) and one segment of flags are kept in memory
+    """
+    base = primes_below(utils.isqrt(max(b - 1, 0)) + 1)
+    lo = max(a, 2)
+    while lo < b:
+        hi = min(lo + segment, b)
+        f = bytearray([1]) * (hi - lo)
+        for p in base:
+            if p * p >= hi:
+                break
+            i = max(p * p, (lo + p - 1) // p * p) - lo
+            if i < hi - lo:
+                f[i::p] = bytearray((hi - lo - 1 - i) // p + 1)
+        for x in itertools.compress(itertools.count(lo), f):
+            yield x
+        lo = hi
 
+def prime_generator():
+    """
+    yield all primes, segment by segment
+    """
+    lo = 0
     while True:
-        if test(n - 1):
-            yield n - 1
-        if test(n + 1):
-            yield n + 1
-        n += 6
+        for p in primes_in_range(lo, lo + SEGMENT_SIZE):
+            yield p
+        lo += SEGMENT_SIZE
 
-PRIMES_3000 = list(itertools.takewhile(lambda x: x < 3000, prime_generator()))
+SMALL_SIEVE = sieve(SEGMENT_SIZE)
+SMALL_PRIMES = primes_below(SEGMENT_SIZE)
+PRIMES_3000 = primes_below(3000)
+SIEVE_PRIMES = PRIMES_3000[1:] # odd primes only, candidates are always odd
 
 def length_in_bits(x):
     return int(math.log(x, 2))
 
+BITSET_MAGIC = b'PBIT'
+BITSET_HEADER = struct.Struct('<4sQ') # magic, bound
+BITSET_SEGMENT = SEGMENT_SIZE * 8 # odd numbers per segment
+
+_bitset = None # (mmap, bound)
+if utils.pyversion == 2:
+    _bitset_byte = lambda m, i: ord(m[i])
+else:
+    _bitset_byte = lambda m, i: m[i]
+
+def write_bitset(path, bound):
+    """
+    write primality of odd numbers below bound to path, bit i (little-endian
+    bit order) stands for 2i + 1, one segment is sieved and written at a time
+    """
+    base = primes_below(utils.isqrt(max(bound - 1, 0)) + 1)[1:]
+    count = bound // 2 # odd numbers below bound
+    to_ascii = bytearray(range(256))
+    to_ascii[0:2] = b'01'
+
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(BITSET_HEADER.pack(BITSET_MAGIC, bound))
+        for lo in range(0, count, BITSET_SEGMENT):
+            n = min(BITSET_SEGMENT, count - lo)
+            flags = bytearray([1]) * n + bytearray(-n % 8)
+            if lo == 0:
+                flags[0] = 0 # 1 is not prime
+            for p in base:
+                # first odd multiple of p which is at least max(p^2, 2lo + 1)
+                start = max(p * p, ((2 * lo + 1 + p - 1) // p) * p)
+                if start & 1 == 0:
+                    start += p
+                i = (start >> 1) - lo
+                if i >= n:
+                    if p * p >= 2 * (lo + n):
+                        break
+                    continue
+                flags[i:n:p] = bytearray((n - 1 - i) // p + 1)
+            bits = int(utils.Bytes(flags.translate(to_ascii))[::-1], 2)
+            f.write(utils.int2bytes(bits, len(flags) // 8))
+    os.rename(tmp, path)
+
+def load_bitset(path):
+    """
+    memory-map bitset from write_bitset, is_prime answers numbers below its
+    bound with one byte lookup, the file is shared through the page cache
+    """
+    global _bitset
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < BITSET_HEADER.size:
+            raise ValueError('not a prime bitset file')
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, bound = BITSET_HEADER.unpack(m[:BITSET_HEADER.size])
+    if magic != BITSET_MAGIC:
+        raise ValueError('not a prime bitset file')
+    _bitset = (m, bound)
+    return bound
+
+def check_hash_bases(path):
+    """
+    one-off check of HASH_BASES_32 against bitset from write_bitset, return
+    list of odd numbers below min(bound, 2^32) the hashed base gets wrong, a
+    bitset to 2^32 takes 256 MiB and hours of modular exponentiations
+    """
+    global _bitset
+    previous = _bitset
+    try:
+        bound = min(load_bitset(path), HASH_BASES_BOUND)
+        return [x for x in range(3, bound, 2) if is_deterministic_prime(x) != is_prime(x)]
+    finally:
+        _bitset = previous
+
 def is_prime(x):
     x = int(x)
     if x < 1:
         raise ValueError('value too small')
-    if x < 3000:
-        return binsearch(x, PRIMES_3000)
+    if x < len(SMALL_SIEVE):
+        return SMALL_SIEVE[x] == 1
     if x % 2 == 0:
         return False
+    if _bitset is not None and x < _bitset[1]:
+        i = (x >> 1) + BITSET_HEADER.size * 8
+        return (_bitset_byte(_bitset[0], i >> 3) >> (i & 7)) & 1 == 1
+    if x < DETERMINISTIC_BOUND:
+        return is_deterministic_prime(x)
 
-    stop = int(x ** 0.5)
-    for p in prime_generator():
+    stop = utils.isqrt(x)
+    primes = SMALL_PRIMES if stop < SEGMENT_SIZE else prime_generator()
+    for p in primes:
         if p > stop:
             return True
         if x % p == 0:
             return False
+    return True
 
-def is_probable_prime(x, check=12, recheck=0):
+def jacobi(a, n):
+    """
+    Jacobi symbol (a / n), n must be odd and positive
+    """
+    a %= n
+    result = 1
+    while a:
+        while a & 1 == 0:
+            a >>= 1
+            if n & 7 in (3, 5):
+                result = -result
+        a, n = n, a
+        if a & 3 == 3 and n & 3 == 3:
+            result = -result
+        a %= n
+    return result if n == 1 else 0
+
+def is_strong_lucas_prp(n):
+    """
+    strong Lucas probable prime test, parameters are chosen by Selfridge's
+    method A: first D in 5, -7, 9, -11, ... with (D / n) = -1, P = 1, Q = (1 - D) / 4
+    """
+    if utils.isqrt(n) ** 2 == n: # no such D exists for perfect squares
+        return False
+
+    D = 5
+    while True:
+        j = jacobi(D, n)
+        if j == -1:
+            break
+        if j == 0 and abs(D) != n:
+            return False
+        D = -D - 2 if D > 0 else -D + 2
+    P, Q = 1, (1 - D) // 4
+
+    d, s = n + 1, 0
+    while d & 1 == 0:
+        d, s = d >> 1, s + 1
+
+    def half(x): # x / 2 (mod n)
+        x %= n
+        return (x + n if x & 1 else x) >> 1
+
+    # U, V, Q^k for k = 1, then walk through the bits of d
+    U, V, Qk = 1, P, Q % n
+    for bit in bin(d)[3:]:
+        U, V, Qk = U * V % n, (V * V - 2 * Qk) % n, Qk * Qk % n
+        if bit == '1':
+            U, V, Qk = half(P * U + V), half(D * U + P * V), Qk * Q % n
+
+    if U == 0 or V == 0:
+        return True
+    for r in range(1, s):
+        V, Qk = (V * V - 2 * Qk) % n, Qk * Qk % n
+        if V == 0:
+            return True
+    return False
+
+# (bound, bases), Miller-Rabin with these bases is exact for n < bound
+DETERMINISTIC_BASES = [
+    (2047, (2, )),
+    (1373653, (2, 3)),
+    (9080191, (31, 73)),
+    (4759123141, (2, 7, 61)),
+    (1122004669633, (2, 13, 23, 1662803)),
+    (2152302898747, (2, 3, 5, 7, 11)),
+    (3474749660383, (2, 3, 5, 7, 11, 13)),
+    (341550071728321, (2, 3, 5, 7, 11, 13, 17)),
+    (3825123056546413051, (2, 3, 5, 7, 11, 13, 17, 19, 23)),
+    (2**64, (2, 325, 9375, 28178, 450775, 9780504, 1795265022)),
+    (318665857834031151167461, (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37)),
+    (3317044064679887385961981, (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)),
+]
+DETERMINISTIC_BOUND = DETERMINISTIC_BASES[-1][0]
+
+# one Miller-Rabin base for each hash bucket of odd x < 2^32 which has no
+# factor 3, 5 or 7, exact for the whole range (Forisek and Jancina, Fast
+# Primality Testing for Integers That Fit into a Machine Word, 2015)
+HASH_BASES_32 = [
+    15591, 2018, 166, 7429, 8064, 16045, 10503, 4399, 1949, 1295, 2776, 3620, 560, 3128, 5212, 2657,
+    2300, 2021, 4652, 1471, 9336, 4018, 2398, 20462, 10277, 8028, 2213, 6219, 620, 3763, 4852, 5012,
+    3185, 1333, 6227, 5298, 1074, 2391, 5113, 7061, 803, 1269, 3875, 422, 751, 580, 4729, 10239,
+    746, 2951, 556, 2206, 3778, 481, 1522, 3476, 481, 2487, 3266, 5633, 488, 3373, 6441, 3344,
+    17, 15105, 1490, 4154, 2036, 1882, 1813, 467, 3307, 14042, 6371, 658, 1005, 903, 737, 1887,
+    7447, 1888, 2848, 1784, 7559, 3400, 951, 13969, 4304, 177, 41, 19875, 3110, 13221, 8726, 571,
+    7043, 6943, 1199, 352, 6435, 165, 1169, 3315, 978, 233, 3003, 2562, 2994, 10587, 10030, 2377,
+    1902, 5354, 4447, 1555, 263, 27027, 2283, 305, 669, 1912, 601, 6186, 429, 1930, 14873, 1784,
+    1661, 524, 3577, 236, 2360, 6146, 2850, 55637, 1753, 4178, 8466, 222, 2579, 2743, 2031, 2226,
+    2276, 374, 2132, 813, 23788, 1610, 4422, 5159, 1725, 3597, 3366, 14336, 579, 165, 1375, 10018,
+    12616, 9816, 1371, 536, 1867, 10864, 857, 2206, 5788, 434, 8085, 17618, 727, 3639, 1595, 4944,
+    2129, 2029, 8195, 8344, 6232, 9183, 8126, 1870, 3296, 7455, 8947, 25017, 541, 19115, 368, 566,
+    5674, 411, 522, 1027, 8215, 2050, 6544, 10049, 614, 774, 2333, 3007, 35201, 4706, 1152, 1785,
+    1028, 1540, 3743, 493, 4474, 2521, 26845, 8354, 864, 18915, 5465, 2447, 42, 4511, 1660, 166,
+    1249, 6259, 2553, 304, 272, 7286, 73, 6554, 899, 2816, 5197, 13330, 7054, 2818, 3199, 811,
+    922, 350, 7514, 4452, 3449, 2663, 4708, 418, 1621, 1171, 3471, 88, 11345, 412, 1559, 194,
+]
+HASH_BASES_BOUND = 2**32
+
+def hash_bucket(x):
+    """
+    index of the base of x in HASH_BASES_32
+    """
+    x = ((x >> 16) ^ x) * 0x45d9f3b
+    x = ((x >> 16) ^ x) * 0x45d9f3b
+    return ((x >> 16) ^ x) & 255
+
+# name: (bound, [(max key length, -log2 of error probability), ...]), the
+# last entry covers longer keys. 'average' bounds the error of a random
+# candidate (Damgard, Landrock and Pomerance), 'worst' holds for any input
+PROFILES = {
+    'fast':     ('average', [(None, 80)]),
+    'fips186':  ('average', [(1024, 100), (2048, 112), (None, 128)]), # FIPS 186-4 C.3
+    'paranoid': ('worst', [(None, 128)]),
+}
+DEFAULT_PROFILE = 'fips186'
+
+def mr_error_log2(k, t):
+    """
+    log2 of upper bound of probability that a random odd k bits composite
+    passes t rounds of Miller-Rabin with random bases (Damgard, Landrock and
+    Pomerance, 1993), the best of the bounds which apply to (k, t)
+    """
+    lk = math.log(k, 2)
+    best = -2.0 * t # 4^-t, holds for any input
+    if t == 1 and k >= 2:
+        best = min(best, 2 * lk + 2 * (2 - math.sqrt(k)))
+    if k >= 21 and (t == 2 and k >= 88 or 3 <= t <= k / 9.0):
+        best = min(best, 1.5 * lk + t - 0.5 * math.log(t, 2) + 2 * (2 - math.sqrt(t * k)))
+    if k >= 21 and k / 9.0 <= t <= k / 4.0:
+        p = 7 / 20.0 * k * 2**(-5.0 * t) + k**3.75 / 7.0 * 2**(-k / 2.0 - 2 * t) + 12 * k * 2**(-k / 4.0 - 3 * t)
+        best = min(best, math.log(p, 2))
+    if k >= 21 and t >= k / 4.0:
+        best = min(best, 3.75 * lk - math.log(7, 2) - k / 2.0 - 2 * t)
+    return best
+
+_mr_rounds = {} # (bits, target): rounds
+
+def mr_rounds(bits, profile=DEFAULT_PROFILE, nlen=None):
+    """
+    rounds of Miller-Rabin with random bases a `bits` bits candidate needs to
+    reach the error target of `profile` for a key of nlen bits (default 2 *
+    bits, two primes key)
+    """
+    if profile not in PROFILES:
+        raise ValueError('unknown primality profile %r' % profile)
+    bound, targets = PROFILES[profile]
+    nlen = nlen or 2 * bits
+    target = next(t for n, t in targets if n is None or nlen <= n)
+    if bound == 'worst':
+        return (target + 1) // 2
+    if (bits, target) not in _mr_rounds:
+        t = 1
+        while mr_error_log2(bits, t) > -target:
+            t += 1
+        _mr_rounds[(bits, target)] = t
+    return _mr_rounds[(bits, target)]
+
+def _try_comp(a, d, n, s):
+    """
+    return True if a is a witness for compositeness of n, n - 1 = d * 2^s
+    """
+    b = pow(a, d, n)
+    if b == 1:
+        return False
+    n_1 = n - 1
+    for i in range(s):
+        if b == n_1:
+            return False
+        b = pow(b, 2, n) # b = (b * b) % n
+    return True
+
+def is_deterministic_prime(x):
+    """
+    exact primality test for odd x in [3, DETERMINISTIC_BOUND), one hashed
+    base below 2^32, otherwise the smallest known set of Miller-Rabin bases
+    for the size of x
+    """
+    if x < HASH_BASES_BOUND:
+        if x in (3, 5, 7):
+            return True
+        if x % 3 == 0 or x % 5 == 0 or x % 7 == 0:
+            return False
+        if x < 121:
+            return True
+
+    d = x - 1
+    s = 0
+    while d & 1 == 0:
+        d, s = d >> 1, s + 1
+
+    if x < HASH_BASES_BOUND:
+        return not _try_comp(HASH_BASES_32[hash_bucket(x)], d, x, s)
+    for bound, bases in DETERMINISTIC_BASES:
+        if x < bound:
+            return not any(_try_comp(a % x, d, x, s) for a in bases if a % x)
+    raise ValueError('value too large')
+
+def is_probable_prime(x, check=None, recheck=0, method='mr', token=None):
+    """
+    method  'mr'    `check` rounds of Miller-Rabin with small prime bases
+            'bpsw'  Baillie-PSW, strong test to base 2 and strong Lucas test
+
+    `recheck` more rounds of Miller-Rabin with random bases are run at last
+    below DETERMINISTIC_BOUND the answer is exact and no extra round is run.
+    without `check`, 'mr' runs one round with base 2 followed by the rounds of
+    DEFAULT_PROFILE with random bases, 'bpsw' adds no round. `token` is a
+    CancelToken ticked before every round
+    """
+    if method not in ('mr', 'bpsw'):
+        raise ValueError('unknown primality test %r' % method)
     if x < 3000:
         return is_prime(x)
     if x % 2 == 0:
         return False
+    if x < DETERMINISTIC_BOUND:
+        return is_deterministic_prime(x)
 
-    if not check or check < 5:
-        check = max(int(math.log(math.log(x), 2) * 1.5), 5)
-
-    def _try_comp(a, d, n, s):
-        b = pow(a, d, n)
-        if b == 1:
-            return False
-        n_1 = n - 1
-        for i in range(s):
-            if b == n_1:
-                return False
-            b = pow(b, 2, n) # b = (b * b) % n
-        return True
+    if check is None:
+        check = 1
+        if method == 'mr':
+            recheck += mr_rounds(x.bit_length())
 
     d = x - 1
     s = 0
     while d & 1 == 0:
         d, s = d >> 1, s + 1
 
-    if any(_try_comp(p, d, x, s) for p in PRIMES_3000[:check]):
+    def composite(a):
+        if token:
+            token.tick(0, 1)
+        return _try_comp(a, d, x, s)
+
+    if method == 'bpsw':
+        if composite(2) or not is_strong_lucas_prp(x):
+            return False
+    elif any(composite(p) for p in PRIMES_3000[:check]):
         return False
     if recheck < 1:
         return True
-    return not any(_try_comp(p, d, x, s) for p in random.sample(PRIMES_3000[check:], recheck))
+    return not any(composite(randrange(2, x - 1)) for i in range(recheck))
 
-def randprime_range(a, b, c=None):
-    if not c:
-        if b > 2**64:
-            c = int(math.log(math.log(b, 10), 2) * 1.5)
-        else:
-            c = 13
+def sieve_walk(k, b, step=2, exclude=(), primes=None, window=None):
+    """
+    yield k, k + step, k + 2 * step, ... below b, skipping numbers which have
+    a factor in `primes` or hit a residue in `exclude`
+
+    exclude     list of (m, r), x = r (mod m) is skipped, m must be odd
+
+    windows of offsets are sieved against the residues of k modulo small
+    primes, so rejected numbers cost no modular exponentiation
+    """
+    if window is None:
+        window = max(256, k.bit_length() * 2)
+    if numpy is not None:
+        for x in _np_sieve_walk(k, b, step, exclude, primes, window):
+            yield x
+        return
+
+    if primes is None:
+        primes = SIEVE_PRIMES
+    # do not sieve out the small primes themselves
+    rules = [(p, 0) for p in primes if p < k] + list(exclude)
+    # k + step * i = r (mod m)  =>  i = (r - k) * inverse(step) (mod m)
+    rules = [(m, r, utils.modinv(step % m, m)) for m, r in rules if step % m]
+
+    while k < b:
+        n = min(window, (b - k + step - 1) // step)
+        composite = bytearray(n)
+        for m, r, inv in rules:
+            i = (r - k) * inv % m
+            if i < n:
+                composite[i::m] = b'\x01' * ((n - 1 - i) // m + 1)
+        for i in range(n):
+            if not composite[i]:
+                yield k + step * i
+        k += step * n
+
+def sieve_range(a, b, primes=None, window=None, exclude=()):
+    """
+    yield odd numbers in [a, b) which have no factor in `primes`
 
+    pick one random start and walk through odd numbers with sieve_walk,
+    restart from another random point when running out of range.
+    """
     while True:
         k = randrange(a, b) | 1 # ensure it's not even
-        if is_probable_prime(k, c):
+        for x in sieve_walk(k, b, 2, exclude, primes, window):
+            yield x
+
+_np_sieve_primes = None
+
+def np_sieve_primes():
+    """
+    numpy array of odd primes below NUMPY_SIEVE_LIMIT
+    """
+    global _np_sieve_primes
+    if _np_sieve_primes is None:
+        _np_sieve_primes = _np_primes_below(NUMPY_SIEVE_LIMIT)[1:]
+    return _np_sieve_primes
+
+def _np_primes_below(n):
+    """
+    numpy array of primes less than n, sieve over odd numbers only
+    """
+    f = numpy.ones(n // 2, dtype=bool) # f[i] stands for 2i + 1
+    f[0] = False
+    for i in range(3, utils.isqrt(max(n - 1, 0)) + 1, 2):
+        if f[i // 2]:
+            f[i * i // 2::i] = False
+    primes = 2 * numpy.flatnonzero(f) + 1
+    return numpy.concatenate(([2], primes)) if n > 2 else primes
+
+def _np_residues(x, ms):
+    """
+    x modulo every element of int64 array ms (all below 2^31), x is fed in
+    32 bits limbs from the most significant one
+    """
+    r = numpy.zeros(len(ms), dtype=numpy.int64)
+    for shift in range((x.bit_length() + 31) // 32 * 32 - 32, -1, -32):
+        r = ((r << 32) + ((x >> shift) & 0xffffffff)) % ms
+    return r
+
+def _np_sieve_walk(k, b, step, exclude, primes, window):
+    """
+    numpy version of sieve_walk, sieves deeper (primes below bits^2 of k, at
+    most NUMPY_SIEVE_LIMIT) and marks all rules of a window in one pass
+    """
+    if primes is None:
+        table = np_sieve_primes()
+        primes = table[:numpy.searchsorted(table, k.bit_length() ** 2)]
+    ms = numpy.asarray(primes, dtype=numpy.int64)
+    ms = ms[ms < k] # do not sieve out the small primes themselves
+
+    # inverse of step by Fermat's little theorem, step^(m - 2) (mod m)
+    if step == 2:
+        invs = (ms + 1) >> 1
+    else:
+        a, e = _np_residues(step, ms), ms - 2
+        invs = numpy.ones(len(ms), dtype=numpy.int64)
+        while e.any():
+            invs = numpy.where(e & 1, invs * a % ms, invs)
+            a, e = a * a % ms, e >> 1
+
+    extra = [(m, r, utils.modinv(step % m, m)) for m, r in exclude if step % m]
+    rs = numpy.array([r for m, r, inv in extra], dtype=numpy.int64)
+    ms = numpy.concatenate((ms, [m for m, r, inv in extra])).astype(numpy.int64)
+    invs = numpy.concatenate((invs, [inv for m, r, inv in extra])).astype(numpy.int64)
+    keep = invs != 0 # step = 0 (mod m)
+    rs = numpy.concatenate((numpy.zeros(len(ms) - len(rs), dtype=numpy.int64), rs))
+    ms, rs, invs = ms[keep], rs[keep], invs[keep]
+
+    # k + step * i = r (mod m)  =>  i = (r - k) * inverse(step) (mod m),
+    # moving k by step * n moves every i by -n
+    first = (rs - _np_residues(k, ms)) % ms * invs % ms
+    while k < b:
+        n = min(window, (b - k + step - 1) // step)
+        hit = first < n
+        i, m = first[hit], ms[hit]
+        counts = (n - 1 - i) // m + 1
+        offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        composite = numpy.zeros(n, dtype=bool)
+        composite[numpy.repeat(i, counts) + offsets * numpy.repeat(m, counts)] = True
+        for i in numpy.flatnonzero(~composite).tolist():
+            yield k + step * i
+        k += step * n
+        first = (first - n) % ms
+
+def product_tree(xs):
+    """
+    tree[0] is xs, every next level holds products of pairs of previous level,
+    tree[-1] is [product of xs]
+    """
+    tree = [list(xs)]
+    while len(tree[-1]) > 1:
+        level = tree[-1]
+        tree.append([level[i] * level[i+1] if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)])
+    return tree
+
+def remainder_tree(x, tree):
+    """
+    x modulo every leaf of product tree
+    """
+    rems = [x % tree[-1][0]]
+    for level in reversed(tree[:-1]):
+        rems = [rems[i >> 1] % v for i, v in enumerate(level)]
+    return rems
+
+_small_primorial = None
+_batch_primorial = None
+
+def small_primorial():
+    """
+    product of odd primes below 3000
+    """
+    global _small_primorial
+    if _small_primorial is None:
+        _small_primorial = product_tree(SIEVE_PRIMES)[-1][0]
+    return _small_primorial
+
+def batch_primorial():
+    """
+    product of primes in [3000, 65536), the ones sieve_range does not cover
+    """
+    global _batch_primorial
+    if _batch_primorial is None:
+        primes = SMALL_PRIMES[len(PRIMES_3000):]
+        _batch_primorial = product_tree(primes)[-1][0]
+    return _batch_primorial
+
+def prepare_tables():
+    """
+    build lazily created sieve and primorial tables now, workers forked later
+    share them instead of building their own
+    """
+    if numpy is not None:
+        np_sieve_primes()
+    small_primorial()
+    batch_primorial()
+
+def batch_filter(xs, primorial=None):
+    """
+    return numbers in xs which are coprime to primorial
+
+    remainders of primorial modulo all numbers are computed with one
+    remainder tree, then one gcd per number, all big integer work is done
+    in a few large operations
+    """
+    if not xs:
+        return []
+    if primorial is None:
+        primorial = batch_primorial()
+    rems = remainder_tree(primorial, product_tree(xs))
+    return [x for x, r in zip(xs, rems) if utils.gcd(r, x) == 1]
+
+class Cancelled(Exception):
+    pass
+
+class DeadlineExceeded(Cancelled):
+    pass
+
+Progress = collections.namedtuple('Progress', ['candidates', 'rounds', 'elapsed', 'eta'])
+
+class CancelToken(object):
+    """
+    stop a prime search from another thread or after `timeout` seconds, and
+    report its progress to `progress` every `interval` seconds
+
+    the search calls tick for every candidate and before every Miller-Rabin
+    round or Pocklington base, which raises Cancelled (or DeadlineExceeded)
+    once the token is cancelled, so it stops within one modular
+    exponentiation. progress is called with Progress of candidates tested,
+    Miller-Rabin rounds run, seconds elapsed and estimated seconds remaining
+    (None until `expected` candidates are known)
+
+    shared      multiprocessing.Array of 2 counters, ticks are added to it so
+                a parent process can follow workers
+    """
+
+    def __init__(self, timeout=None, progress=None, interval=0.5, shared=None):
+        self.start = self.reported = time.time()
+        self.deadline = self.start + timeout if timeout else None
+        self.progress = progress
+        self.interval = interval
+        self.shared = shared
+        self.cancelled = False
+        self.candidates = self.rounds = 0
+        self.expected = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled('prime search cancelled')
+        if self.deadline and time.time() > self.deadline:
+            raise DeadlineExceeded('prime search ran out of time')
+
+    def tick(self, candidates=1, rounds=1):
+        self.candidates += candidates
+        self.rounds += rounds
+        if self.shared is not None:
+            with self.shared.get_lock():
+                self.shared[0] += candidates
+                self.shared[1] += rounds
+        self.check()
+        if self.progress and time.time() - self.reported >= self.interval:
+            self.report()
+
+    def report(self):
+        self.reported = time.time()
+        elapsed = self.reported - self.start
+        eta = None
+        if self.expected and self.candidates:
+            eta = max(self.expected - self.candidates, 0) * elapsed / self.candidates
+        self.progress(Progress(self.candidates, self.rounds, elapsed, eta))
+
+def expected_candidates(bits):
+    """
+    expected number of sieved candidates tested until a `bits` bits prime is
+    found, by Mertens' theorem for the primes the sieve covers
+    """
+    if numpy is not None:
+        bound = min(bits ** 2, NUMPY_SIEVE_LIMIT)
+    elif bits > BATCH_MIN_BITS:
+        bound = SMALL_PRIMES[-1]
+    else:
+        bound = PRIMES_3000[-1]
+    return bits * math.log(2) * math.exp(-0.5772156649) / math.log(max(bound, 3))
+
+def coprime_exclude(e):
+    """
+    sieve rules which skip x = 1 (mod f) for every small odd prime factor f of
+    e, gcd(e, x - 1) = 1 is still needed when e has larger factors
+    """
+    return [(f, 1) for f in SIEVE_PRIMES if e % f == 0]
+
+def randprime_range(a, b, c=None, method='mr', e=None, token=None):
+    """
+    random prime in [a, b), with `e`, only primes p where gcd(e, p - 1) = 1
+    are returned, others are skipped before any Miller-Rabin round
+
+    with method 'mr', candidates pass a round with base 2 and `c` rounds with
+    random bases, c defaults to rounds of DEFAULT_PROFILE. `token` is a
+    CancelToken which is ticked for every candidate
+    """
+    if not c:
+        c = mr_rounds(a.bit_length())
+    recheck = c if method == 'mr' else 0
+
+    if e:
+        assert e & 1, 'e must be odd'
+        sieved = (k for k in sieve_range(a, b, exclude=coprime_exclude(e)) if utils.gcd(e, k - 1) == 1)
+    else:
+        sieved = sieve_range(a, b)
+    if a.bit_length() > BATCH_MIN_BITS and numpy is None: # numpy sieves deeper already
+        batches = iter(lambda: list(itertools.islice(sieved, BATCH_SIZE)), [])
+        candidates = (k for batch in batches for k in batch_filter(batch))
+    else:
+        candidates = sieved
+
+    for k in candidates:
+        if token:
+            token.tick(1, 0)
+        if is_probable_prime(k, 1, recheck, method, token):
             return k
 
-def randprime_bits(n=256):
-    return randprime_range(2**n, 2**(n+1))
+def randprime_bits(n=256, method='mr', e=None, c=None, token=None):
+    """
+    random prime in [2^n, 2^(n+1)), method is 'mr', 'bpsw' or 'provable',
+    gcd(e, p - 1) = 1 if `e` is given, `c` and `token` as randprime_range
+    """
+    if method == 'provable':
+        return randprime_provable(n + 1, e=e, token=token)
+    return randprime_range(2**n, 2**(n+1), c, method, e, token)
+
+def randprime_provable(bits, certificate=False, e=None, token=None):
+    """
+    random prime of exactly `bits` bits with Maurer's recursive construction
+
+    p = 2Rq + 1 where q is a proven prime larger than sqrt(p), then p is
+    proven by Pocklington's criterion with a base a:
+        a^(p-1) = 1 (mod p) and gcd(a^(2R) - 1, p) = 1
+    primes below DETERMINISTIC_BOUND are proven by deterministic Miller-Rabin
+
+    with `certificate`, return (p, cert), cert is a list of (n, a) from p down
+    to the smallest prime (its a is None), see verify_certificate. with `e`,
+    p where gcd(e, p - 1) != 1 are skipped before Pocklington's test, `token`
+    as randprime_range
+    """
+    assert bits >= 2, 'prime must be at least 2 bits'
+    if 2**bits <= DETERMINISTIC_BOUND:
+        p = randprime_range(2**(bits-1), 2**bits, e=e, token=token)
+        return (p, [(p, None)]) if certificate else p
+
+    q, cert = randprime_provable((bits + 1) // 2 + 1, True, token=token) # q > 2^(bits/2) > sqrt(p)
+    lo = (2**(bits-1) - 1) // (2 * q) + 1
+    hi = (2**bits - 2) // (2 * q) + 1
+    primorial = small_primorial()
+    while True:
+        R = randrange(lo, hi)
+        p = 2 * R * q + 1
+        if utils.gcd(p, primorial) != 1 or (e and utils.gcd(e, 2 * R * q) != 1):
+            continue
+        if token:
+            token.tick(1, 0)
+        for a in PRIMES_3000[:6]:
+            if token:
+                token.tick(0, 1)
+            if pow(a, p - 1, p) != 1: # composite
+                break
+            if utils.gcd(pow(a, 2 * R, p) - 1, p) == 1:
+                cert.insert(0, (p, a))
+                return (p, cert) if certificate else p
+
+def verify_certificate(cert):
+    """
+    check certificate from randprime_provable, return the proven prime or None
+    """
+    for (n, a), (q, _) in zip(cert, cert[1:]):
+        if (n - 1) % q or q * q <= n or not a:
+            return None
+        if pow(a, n - 1, n) != 1 or utils.gcd(pow(a, (n - 1) // q, n) - 1, n) != 1:
+            return None
+    n = cert[-1][0]
+    if n >= DETERMINISTIC_BOUND or not is_prime(n):
+        return None
+    return cert[0][0]
+
+def randprime_safe(bits):
+    """
+    random safe prime p = 2q + 1 of exactly `bits` bits, q is prime too
+
+    q is sieved against both q = 0 and 2q + 1 = 0 modulo small primes, so only
+    candidates where neither number has a small factor are tested
+    """
+    assert bits >= 3, 'safe prime must be at least 3 bits'
+    lo, hi = 2**(bits-2), 2**(bits-1)
+    exclude = [(m, m >> 1) for m in SIEVE_PRIMES if m < 2 * lo] # 2q + 1 = 0 (mod m)
+    for q in sieve_range(lo, hi, exclude=exclude):
+        p = 2 * q + 1
+        if q > 3 and (pow(2, q - 1, q) != 1 or pow(2, p - 1, p) != 1):
+            continue
+        # q is prime and 2^(p-1) = 1 (mod p), then p is prime by Pocklington
+        if is_probable_prime(q) and (q <= 3 or p % 3):
+            return p
+
+def randprime_strong(bits):
+    """
+    random strong prime p of exactly `bits` bits with Gordon's algorithm,
+    p - 1 has a large prime factor r, p + 1 has a large prime factor s and
+    r - 1 has a large prime factor t
+    """
+    assert bits >= 256, 'strong prime must be at least 256 bits'
+    h = bits // 2 - 32
+    s = randprime_bits(h - 1)
+    t = randprime_bits(h - 17)
+
+    # r = 2it + 1, about h bits
+    r = None
+    while r is None:
+        k = 2 * t * (randrange(2**(h-1), 2**h) // (2 * t)) + 1
+        r = next((x for x in sieve_walk(k, 2**h, 2 * t) if is_probable_prime(x)), None)
+
+    # p0 = 1 (mod r), p0 = -1 (mod s), then p = p0 + 2jrs keeps both
+    p0 = 2 * pow(s, r - 2, r) * s - 1
+    step = 2 * r * s
+    while True:
+        k = p0 + step * ((randrange(2**(bits-1), 2**bits) - p0) // step + 1)
+        for p in sieve_walk(k, 2**bits, step):
+            if is_probable_prime(p):
+                return p
+
+if os.getenv('PRIME_BITSET'):
+    try:
+        load_bitset(os.getenv('PRIME_BITSET'))
+    except (IOError, OSError, ValueError) as e:
+        logger.warning('prime bitset not loaded: %s', e)
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['bitset']:
+        if len(sys.argv) != 4:
+            print('usage: %s bitset FILE BOUND' % sys.argv[0])
+            sys.exit(1)
+        write_bitset(sys.argv[2], int(float(sys.argv[3])))
+        sys.exit()
+    if sys.argv[1:2] == ['checkhash']:
+        if len(sys.argv) != 3:
+            print('usage: %s checkhash FILE' % sys.argv[0])
+            sys.exit(1)
+        wrong = check_hash_bases(sys.argv[2])
+        print('%d wrong answers %s' % (len(wrong), wrong[:16]))
+        sys.exit(1 if wrong else 0)
+
     for bits in (16, 32, 64, 128, 256, 512, 1024):
         res = None
         def p(s):
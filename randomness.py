@@ -0,0 +1,186 @@
+"""
+random sources of prime search and key generation
+
+    UrandomSource   os.urandom read in large chunks, default source
+    HashDRBG        SHA-512 in counter mode from a seed, reproducible
+
+every source hands out bytes from a buffer, integers of any size are cut from
+it, so thousands of small draws cost a few system calls or hash blocks
+
+set RSA_SEED (or NONRANDOM, which uses DEFAULT_SEED) to start with a HashDRBG,
+the same seed gives the same keys on every interpreter
+"""
+
+import contextlib
+import hashlib
+import os
+
+import utils
+
+POOL_SIZE = 4096
+DEFAULT_SEED = 0x28d2c378a13f7985f
+
+class Source(object):
+    """
+    buffered random bytes, subclasses fill the buffer with `_fill`
+    """
+
+    deterministic = False
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.buf = b''
+        self.pos = 0
+
+    def _fill(self):
+        raise NotImplementedError
+
+    def seed(self, seed):
+        """
+        restart the stream from seed, sources which can not be seeded ignore it
+        """
+        pass
+
+    def split(self):
+        """
+        new source independent of this one, for another worker or process
+        """
+        raise NotImplementedError
+
+    def bytes(self, n):
+        if self.pos + n > len(self.buf):
+            if n > self.size:
+                return b''.join(self.bytes(min(n - i, self.size)) for i in range(0, n, self.size))
+            self.buf, self.pos = self.buf[self.pos:] + self._fill(), 0
+        data = self.buf[self.pos:self.pos + n]
+        self.pos += n
+        return data
+
+    def getrandbits(self, k):
+        """
+        random integer in [0, 2^k)
+        """
+        if k <= 0:
+            return 0
+        n = (k + 7) // 8
+        return utils.bytes2int(self.bytes(n)) >> (n * 8 - k)
+
+    def randrange(self, a, b):
+        """
+        uniform random integer in [a, b), out of range draws are rejected
+        """
+        r = b - a
+        if r <= 0:
+            raise ValueError('empty range for randrange(%d, %d)' % (a, b))
+        k = r.bit_length()
+        while True:
+            x = self.getrandbits(k)
+            if x < r:
+                return a + x
+
+class UrandomSource(Source):
+    """
+    CSPRNG backed by os.urandom, the buffer is dropped in a forked child so
+    processes never share random bytes
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        Source.__init__(self, size)
+        self.pid = os.getpid()
+
+    def _fill(self):
+        return os.urandom(self.size)
+
+    def split(self):
+        return UrandomSource(self.size)
+
+    def bytes(self, n):
+        if self.pid != os.getpid():
+            self.buf, self.pos, self.pid = b'', 0, os.getpid()
+        return Source.bytes(self, n)
+
+class HashDRBG(Source):
+    """
+    deterministic generator, block i of the stream is SHA-512(key || i) where
+    key is SHA-512(seed), the n-th split stream is seeded with
+    (b'split' || key || n), so splitting does not consume the stream
+    """
+
+    deterministic = True
+
+    def __init__(self, seed=DEFAULT_SEED, size=POOL_SIZE):
+        Source.__init__(self, size)
+        self.seed(seed)
+
+    def seed(self, seed):
+        if type(seed) in utils.IntTypes:
+            seed = utils.int2bytes(seed, max(1, (seed.bit_length() + 7) // 8))
+        self.key = hashlib.sha512(utils.ensure_bytes(seed)).digest()
+        self.counter = self.splits = 0
+        self.buf, self.pos = b'', 0
+
+    def split(self):
+        self.splits += 1
+        return HashDRBG(b'split' + self.key + utils.int2bytes(self.splits, 8), self.size)
+
+    def _fill(self):
+        blocks = []
+        for i in range(self.size // 64):
+            blocks.append(hashlib.sha512(self.key + utils.int2bytes(self.counter, 8)).digest())
+            self.counter += 1
+        return b''.join(blocks)
+
+def default_source():
+    """
+    HashDRBG if RSA_SEED (decimal or 0x-prefixed hex) or NONRANDOM is set,
+    otherwise UrandomSource
+    """
+    seed = os.getenv('RSA_SEED')
+    if seed is None and os.getenv('NONRANDOM', False):
+        print('[*] Non-random mode enabled')
+        seed = str(DEFAULT_SEED)
+    if seed is not None:
+        return HashDRBG(int(seed, 0))
+    return UrandomSource()
+
+_source = default_source()
+
+def get_source():
+    return _source
+
+def set_source(source):
+    """
+    replace the process-wide random source, return the previous one
+    """
+    global _source
+    previous, _source = _source, source
+    return previous
+
+@contextlib.contextmanager
+def using(source):
+    """
+    use source inside a with block, the previous source is restored after it
+    """
+    previous = set_source(source)
+    try:
+        yield source
+    finally:
+        set_source(previous)
+
+def seed(seed):
+    """
+    switch to a HashDRBG seeded with seed
+    """
+    set_source(HashDRBG(seed))
+
+def split():
+    return _source.split()
+
+def randrange(a, b):
+    return _source.randrange(a, b)
+
+def getrandbits(k):
+    return _source.getrandbits(k)
+
+def random_bytes(n):
+    return _source.bytes(n)
@@ -1,8 +1,13 @@
+import collections
+import hashlib
+import itertools
 import json
 import logging
+import multiprocessing
 import textwrap
 
 import prime
+import randomness
 from utils import *
 
 logger = logging.getLogger('rsa')
@@ -13,11 +18,157 @@ def hex_or_none(x):
     else:
         return None
 
+POLL_INTERVAL = 0.05 # seconds between checks of cancel token in parallel search
+
+def gen_prime(bits, rounds, primality='mr', e=None, lo=None, token=None):
+    """
+    generate a prime of (bits + 1) bits, Miller-Rabin candidates are tested
+    with `rounds` random bases, with `e`, primes where gcd(e, p - 1) != 1 are
+    never generated, with `lo`, the prime is at least lo. `token` is a
+    prime.CancelToken
+    """
+    if lo and primality != 'provable':
+        return prime.randprime_range(max(lo, 2**bits), 2**(bits+1), rounds, primality, e, token)
+    while True:
+        p = prime.randprime_bits(bits, primality, e, rounds, token)
+        if not lo or p >= lo:
+            return p
+
+_search_shared = None
+
+def _init_search_worker(shared):
+    global _search_shared
+    _search_shared = shared
+
+def _search_prime(args):
+    """
+    process pool task, returns (bits, prime)
+    """
+    bits, rounds, primality, e, source = args
+    randomness.set_source(source)
+    token = prime.CancelToken(shared=_search_shared) if _search_shared is not None else None
+    return bits, gen_prime(bits, rounds, primality, e, token=token)
+
+def gen_primes_parallel(sizes, rounds, workers, primality='mr', e=None, token=None):
+    """
+    search distinct primes of given sizes with a pool of worker processes
+
+    every worker searches independently with a split random source, the
+    first prime of a wanted size is taken and remaining searches are cancelled
+    when all sizes are filled. with a deterministic source, results are taken
+    in task order so the same seed gives the same primes
+
+    with `token`, workers count candidates into shared counters, and token is
+    checked every POLL_INTERVAL seconds while waiting for them
+    """
+    primes = [None] * len(sizes)
+    source = randomness.get_source()
+    imap = 'imap' if source.deterministic else 'imap_unordered'
+    shared = multiprocessing.Array('d', 2) if token else None
+    seen = [0, 0]
+    pool = multiprocessing.Pool(workers, _init_search_worker, (shared, ))
+
+    def results(it):
+        while True:
+            try:
+                yield it.next(POLL_INTERVAL)
+            except multiprocessing.TimeoutError:
+                if not token:
+                    continue
+                counts = shared[:]
+                token.tick(int(counts[0] - seen[0]), int(counts[1] - seen[1]))
+                seen[:] = counts
+            except StopIteration:
+                return
+
+    try:
+        while None in primes:
+            wanted = [bits for bits, p in zip(sizes, primes) if p is None]
+            tasks = [(wanted[i % len(wanted)], rounds, primality, e, source.split()) for i in range(workers)]
+            for bits, p in results(getattr(pool, imap)(_search_prime, tasks)):
+                if p in primes:
+                    continue
+                for i, size in enumerate(sizes):
+                    if primes[i] is None and size == bits:
+                        logger.debug('worker found a %d bits prime', bits)
+                        primes[i] = p
+                        break
+                if None not in primes:
+                    break
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return primes
+
+def _generate_key(args):
+    """
+    process pool task of generate_many, returns a new key
+    """
+    bits, e, nprimes, primality, profile, source = args
+    with randomness.using(source):
+        return RSAKey(bits=bits, e=e, nprimes=nprimes, primality=primality, profile=profile)
+
+def generate_many(n, bits, e=0x10001, workers=None, nprimes=2, primality='mr', profile=prime.DEFAULT_PROFILE):
+    """
+    yield n keys of given size as they are completed
+
+    every key is generated by one worker of a process pool with a split
+    random source. sieve and primorial tables are built before the pool
+    starts, forked workers share them, with the spawn start method (default
+    on macOS and Windows) each worker builds them once in its initializer.
+    with a deterministic source, keys are yielded in order and the same seed
+    gives the same keys
+    """
+    prime.prepare_tables()
+    source = randomness.get_source()
+    tasks = ((bits, e, nprimes, primality, profile, source.split()) for i in range(n))
+    if not workers or workers < 2:
+        for task in tasks:
+            yield _generate_key(task)
+        return
+
+    pool = multiprocessing.Pool(workers, prime.prepare_tables)
+    try:
+        imap = pool.imap if source.deterministic else pool.imap_unordered
+        for key in imap(_generate_key, tasks):
+            yield key
+    finally:
+        pool.terminate()
+        pool.join()
+
+def recover_pq(N, e, d, tries=64):
+    """
+    factor N = p * q with known exponents (e, d), return (p, q) or None
+
+    e * d - 1 is a multiple of lambda(N), write it as 2^t * r and look for a
+    non-trivial square root of 1 modulo N (NIST SP 800-56B, Appendix C)
+    """
+    r, t = e * d - 1, 0
+    while r and r & 1 == 0:
+        r, t = r >> 1, t + 1
+    if t == 0:
+        return None
+
+    for i in range(tries):
+        y = pow(prime.randrange(2, N - 1), r, N)
+        if y == 1 or y == N - 1:
+            continue
+        for j in range(t):
+            x = pow(y, 2, N)
+            if x == 1:
+                p = egcd(y - 1, N)[0]
+                return p, N // p
+            if x == N - 1:
+                break
+            y = x
+    return None
+
 class RSAKey(object):
     KEYS = ['N', 'e', 'd', 'p', 'q', 'dp', 'dq', 'qinv']
 
     @staticmethod
-    def from_json(json_str):
+    def from_json(json_str, factor=False):
         def as_int(x):
             if type(x) in IntTypes:
                 return x
@@ -25,38 +176,103 @@ class RSAKey(object):
                 return int(x, 16)
             else:
                 return int(x, 10)
-        d = { k: as_int(v) for k, v in json.loads(json_str).items() }
-        return RSAKey(**d)
+        d = {}
+        for k, v in json.loads(json_str).items():
+            if v is None:
+                continue
+            elif k == 'others':
+                d[k] = [{ ok: as_int(ov) for ok, ov in o.items() } for o in v]
+            else:
+                d[k] = as_int(v)
+        return RSAKey(factor=factor, **d)
+
+    @staticmethod
+    def from_pool(bits, e=0x10001, pool=None):
+        """
+        take a pre-generated key from key pool, generate one if the pool is empty
+        """
+        import keypool
+        if pool is None:
+            pool = keypool.default_pool()
+        key = pool.take(bits, e)
+        if key is None:
+            logger.info('key pool is empty')
+            key = RSAKey(bits=bits, e=e)
+        return key
 
-    def __init__(self, N=None, e=None, d=None, p=None, q=None, dp=None, dq=None, qinv=None, bits=None):
+    @staticmethod
+    def derive(seed, bits, e=0x10001, cache=None):
+        """
+        deterministic key from (seed, bits, e), derived keys are kept in an on
+        disk key cache, see keycache.py
+        """
+        import keycache
+        if cache is None:
+            cache = keycache.default_cache()
+        return cache.derive(seed, bits, e)
+
+    def __init__(self, N=None, e=None, d=None, p=None, q=None, dp=None, dq=None, qinv=None, others=None,
+                 bits=None, workers=None, nprimes=2, primality='mr', factor=False, carmichael=None,
+                 profile=prime.DEFAULT_PROFILE, token=None):
         """
         One of following set of parameters must be given:
             (N, e), (N, d), (dp, dq, qinv), (e, p, q), (bits)
+
+        others      additional primes of multi-prime key, list of dict with
+                    prime r, CRT exponent d and CRT coefficient t (d, t are
+                    optional), same as OtherPrimeInfos of RFC 8017
+        workers     number of processes used to search primes (bits only)
+        nprimes     number of primes of generated key (bits only)
+        primality   primality test used by key generation, 'mr', 'bpsw' or
+                    'provable'
+        profile     error target of Miller-Rabin, 'fast', 'fips186' or
+                    'paranoid', see prime.PROFILES
+        token       prime.CancelToken with deadline, progress callback and
+                    cancel() for key generation (bits only)
+        factor      recover p, q from (N, e, d) to enable CRT decryption
+        carmichael  compute d modulo lambda(N) instead of phi(N), which gives
+                    a shorter d, default on for generated keys
         """
-        self.p = self.q = self.phi = self.dp = self.dq = self.e = None
+        self.p = self.q = self.phi = self.dp = self.dq = self.qinv = self.e = None
+        self.others = []
 
         if p != None and q != None:
             self.p, self.q = p, q
+            self.others = [dict(o) for o in others or []]
             self.phi = (p - 1) * (q - 1)
             self.N = p * q
+            for o in self.others:
+                self.phi *= o['r'] - 1
+                self.N *= o['r']
         elif N != None:
             self.N = N
         elif bits != None:
-            self.e = 0x10001
-            self.gen_pq(bits)
+            self.e = 0x10001 if e is None else e
+            self.gen_pq(bits, workers, nprimes, primality, profile, token)
         else:
             raise ValueError('N or (p, q) or bits must be given')
 
         if e != None:
             self.e = e
 
+        if carmichael is None:
+            carmichael = bits != None
+
         if d:
             self.d = d
+        elif self.phi and carmichael:
+            lam = 1
+            for x in self.primes:
+                lam = lcm(lam, x - 1)
+            self.d = modinv(self.e, lam)
         elif self.phi:
             self.d = modinv(self.e, self.phi)
         else:
             self.phi = self.d = None
 
+        if factor and not self.p and self.N and e and self.d:
+            self.recover_pq()
+
         if self.phi:
             assert self.e < self.phi
 
@@ -75,36 +291,98 @@ class RSAKey(object):
             else:
                 raise ValueError('dp, dq were given, but can not compute qinv')
 
+        if self.qinv and self.others:
+            R = self.p * self.q
+            for o in self.others:
+                if not o.get('d'):
+                    o['d'] = modinv(self.e, o['r'] - 1)
+                if not o.get('t'):
+                    o['t'] = modinv(R, o['r'])
+                R *= o['r']
+
         if not self._can_decrypt: # at last, we assume e = 65537
             self.e = 0x10001
 
-    def gen_pq(self, bits):
+    def gen_pq(self, bits, workers=None, nprimes=2, primality='mr', profile=prime.DEFAULT_PROFILE, token=None):
         """
-        generate keypair (p, q)
+        generate keypair (p, q) and other primes of multi-prime key, every
+        prime p has gcd(self.e, p - 1) = 1
+
+        workers     search primes with a pool of this many processes
+        nprimes     number of primes, 2 ~ 5
+        primality   'mr' for Miller-Rabin, 'bpsw' for Baillie-PSW,
+                    'provable' for provable primes
+        profile     Miller-Rabin rounds reach the error target of this
+                    profile for a key of `bits` bits
+        token       prime.CancelToken, raises prime.Cancelled when cancelled
+                    or out of time
         """
         assert bits >= 512, 'key length must be at least 512 bits'
-        l = bits >> 1
+        assert 2 <= nprimes <= 5, 'number of primes must between [2, 5]'
+        l = bits // nprimes
+        assert l >= 256, 'primes of multi-prime key must be at least 256 bits'
+        sizes = [l] * (nprimes - 1) + [bits - l * (nprimes - 1)]
+        rounds = prime.mr_rounds(l + 1, profile, bits)
+        if token:
+            token.expected += sum(prime.expected_candidates(size + 1) for size in sizes)
+
+        # phi >= 2^bits, a larger e needs a large enough last prime for e < phi
+        last = None
+        if self.e >= 2**bits:
+            sizes, last = sizes[:-1], sizes[-1]
+
+        if workers and workers > 1:
+            logger.info('generating %d primes with %d workers...', nprimes, workers)
+            primes = gen_primes_parallel(sizes, rounds, workers, primality, self.e, token)
+        else:
+            primes = []
+            for name, size in zip('pqrst', sizes):
+                logger.info('generating %s...', name)
+                p = gen_prime(size, rounds, primality, self.e, token=token)
+                while p in primes:
+                    p = gen_prime(size, rounds, primality, self.e, token=token)
+                primes.append(p)
+
+        if last:
+            rest = 1
+            for p in primes:
+                rest *= p - 1
+            lo = self.e // rest + 2
+            assert lo < 2**(last+1), 'e is too large for key length'
+            p = gen_prime(last, rounds, primality, self.e, lo, token)
+            while p in primes:
+                p = gen_prime(last, rounds, primality, self.e, lo, token)
+            primes.append(p)
+
+        self.p, self.q = primes[:2]
+        self.others = [{ 'r': r } for r in primes[2:]]
+        self.N = self.phi = 1
+        for p in primes:
+            self.N *= p
+            self.phi *= p - 1
+
+    def recover_pq(self):
+        """
+        factor N with (e, d) and fill p, q, return True on success
+        """
+        pq = recover_pq(self.N, self.e, self.d)
+        if not pq or not all(prime.is_probable_prime(x) for x in pq):
+            logger.info('can not factor N with (e, d)')
+            return False
 
-        logger.info('generating p...')
-        while True:
-            p = prime.randprime_bits(l)
-            logger.debug('p generated, rechecking...')
-            if prime.is_probable_prime(p, None, l // 8):
-                break
-            logger.debug('recheck failed. re-generate p')
+        self.p, self.q = max(pq), min(pq)
+        self.phi = (self.p - 1) * (self.q - 1)
+        return True
 
-        logger.info('generating q...')
-        while True:
-            q = prime.randprime_bits(bits - l)
-            logger.debug('q generated, rechecking...')
-            if p != q and prime.is_probable_prime(q, None, l // 8):
-                break
-            logger.debug('recheck failed. re-generate q')
+    @property
+    def primes(self):
+        return [self.p, self.q] + [o['r'] for o in self.others]
 
-        self.p = p
-        self.q = q
-        self.N = p * q
-        self.phi = (p - 1) * (q - 1)
+    def crt_exponents(self, x):
+        """
+        reduce exponent x modulo (r - 1) for every prime r, used by CRT
+        """
+        return [x % (r - 1) for r in self.primes]
 
     @property
     def _can_encrypt(self):
@@ -116,20 +394,33 @@ class RSAKey(object):
 
     @property
     def _can_crt(self):
-        return self.N and self.dq and self.dp and self.qinv and self.p and self.q
+        return self.N and self.dq and self.dp and self.qinv and self.p and self.q and \
+            all(o.get('d') and o.get('t') for o in self.others)
 
     @property
     def block_size(self):
         return (self.N.bit_length() + 7) >> 3
 
+    def fingerprint(self):
+        """
+        SHA-256 digest of modulus N
+        """
+        return hashlib.sha256(int2bytes(self.N, self.block_size)).digest()
+
     def __repr__(self):
-        return 'RSAKey(%s)' % ', '.join('%s=%s' % (k, hex_or_none(getattr(self, k, None))) for k in self.KEYS)
+        fields = ['%s=%s' % (k, hex_or_none(getattr(self, k, None))) for k in self.KEYS]
+        if self.others:
+            fields.append('others=%r' % self.as_dict()['others'])
+        return 'RSAKey(%s)' % ', '.join(fields)
 
     def as_dict(self):
         """
         dump this key object as dict object
         """
-        return { k: hex_or_none(getattr(self, k, None)) for k in self.KEYS }
+        d = { k: hex_or_none(getattr(self, k, None)) for k in self.KEYS }
+        if self.others:
+            d['others'] = [{ k: hex_or_none(o.get(k)) for k in ('r', 'd', 't') } for o in self.others]
+        return d
 
     def to_json(self):
         """
@@ -147,8 +438,7 @@ class RSAKey(object):
             while True:
                 yield prefspc
 
-        def dump_attr(attrname, ident=4):
-            val = getattr(self, attrname, None)
+        def dump_attr(attrname, val, ident=4):
             if not val:
                 print(' ' * ident + '%4s = None' % attrname)
             else:
@@ -156,7 +446,10 @@ class RSAKey(object):
                 print('\n'.join(p + i for p, i in zip(pref_generator(headline), textwrap.wrap('0x%x,' % val))))
         print('RSAKey {')
         for attr in self.KEYS:
-            dump_attr(attr)
+            dump_attr(attr, getattr(self, attr, None))
+        for i, o in enumerate(self.others, 3):
+            for k in ('r', 'd', 't'):
+                dump_attr('%s%d' % (k, i), o.get(k))
         print('}')
 
     def simplify(self):
@@ -182,7 +475,10 @@ class RSA(object):
         if type(msg) not in IntTypes:
             msg = bytes2int(ensure_bytes(msg))
 
-        return pow(msg, self.key.e, self.key.N)
+        if self.key._can_crt:
+            return self._crt_pow(msg, self.key.crt_exponents(self.key.e))
+        else:
+            return pow(msg, self.key.e, self.key.N)
 
     def decrypt(self, msg, useCRT=False):
         """
@@ -201,10 +497,26 @@ class RSA(object):
             return pow(msg, self.key.d, self.key.N)
 
     def _crt_decrypt(self, msg):
-        m1 = pow(msg % self.key.p, self.key.dp, self.key.p)
-        m2 = pow(msg % self.key.q, self.key.dq, self.key.q)
+        return self._crt_pow(msg, [self.key.dp, self.key.dq] + [o['d'] for o in self.key.others])
+
+    def _crt_pow(self, msg, exps):
+        """
+        compute msg ** x mod N with CRT, exps are x reduced modulo (r - 1) for
+        every prime r of key, in the order of RSAKey.primes
+        """
+        m1 = pow(msg % self.key.p, exps[0], self.key.p)
+        m2 = pow(msg % self.key.q, exps[1], self.key.q)
         k = (self.key.qinv * (m1 - m2 + self.key.p)) % self.key.p
-        return m2 + k * self.key.q
+        m = m2 + k * self.key.q
+
+        # Garner's algorithm for other primes, see RFC 8017 section 5.1.2
+        R = self.key.p * self.key.q
+        for o, x in zip(self.key.others, exps[2:]):
+            r = o['r']
+            h = ((pow(msg % r, x, r) - m) * o['t']) % r
+            m += R * h
+            R *= r
+        return m
 
     def encrypt_block(self, msg):
         return int2bytes(self.encrypt(msg), self.key.block_size)
@@ -212,23 +524,122 @@ class RSA(object):
     def decrypt_block(self, msg, useCRT=False):
         return int2bytes(self.decrypt(msg), self.key.block_size - 1)
 
-    def encrypt_data(self, data):
-        bs = self.key.block_size - 1
-        data_stream = (data[i:i+bs] for i in range(0, len(data), bs))
-        return b''.join(self.encrypt_block(block) for block in data_stream)
+    def encrypt_data(self, data, workers=None):
+        return b''.join(self.encrypt_stream([data], workers))
+
+    def decrypt_data(self, data, workers=None):
+        return b''.join(self.decrypt_stream([data], workers))
+
+    def encrypt_stream(self, source, workers=None):
+        """
+        source  readable binary file or iterator of bytes
+        workers encrypt blocks with a pool of this many processes
+
+        yield encrypted blocks, only a few blocks are kept in memory
+        """
+        return self._map_blocks('encrypt_block', iter_blocks(source, self.key.block_size - 1), workers)
+
+    def decrypt_stream(self, source, workers=None):
+        """
+        source  readable binary file or iterator of bytes
+        workers decrypt blocks with a pool of this many processes
 
-    def decrypt_data(self, data):
-        useCRT = self.key._can_crt
-        if useCRT:
+        yield decrypted data, trailing zero bytes of the whole plaintext are
+        stripped like decrypt_data
+        """
+        if self.key._can_crt:
             logger.info('CRT optimize are used')
 
-        bs = self.key.block_size
-        data_stream = (data[i:i+bs] for i in range(0, len(data), bs))
-        return b''.join(self.decrypt_block(block, useCRT)[:bs-1] for block in data_stream).rstrip(b'\x00')
+        zeros = 0 # zero bytes held back, they are emitted if more data follows
+        for block in self._map_blocks('decrypt_block', iter_blocks(source, self.key.block_size), workers):
+            data = block.rstrip(b'\x00')
+            if data:
+                yield b'\x00' * zeros + data
+                zeros = 0
+            zeros += len(block) - len(data)
+
+    def encrypt_file(self, source, dest, workers=None):
+        """
+        encrypt source to writable binary file dest, return bytes written
+        """
+        return write_stream(dest, self.encrypt_stream(source, workers))
+
+    def decrypt_file(self, source, dest, workers=None):
+        """
+        decrypt source to writable binary file dest, return bytes written
+        """
+        return write_stream(dest, self.decrypt_stream(source, workers))
+
+    def _map_blocks(self, method, blocks, workers, chunk=64):
+        """
+        apply method to every block, in order
+
+        with workers, blocks are sent to a process pool in chunks, at most
+        2 chunks per worker are in flight to keep memory usage bounded
+        """
+        if not workers or workers < 2:
+            f = getattr(self, method)
+            for block in blocks:
+                yield f(block)
+            return
+
+        pool = multiprocessing.Pool(workers, _init_block_worker, (self.key, ))
+        try:
+            pending = collections.deque()
+            chunks = iter(lambda: list(itertools.islice(blocks, chunk)), [])
+            for data in chunks:
+                pending.append(pool.apply_async(_block_task, (method, data)))
+                if len(pending) >= workers * 2:
+                    for block in pending.popleft().get():
+                        yield block
+            while pending:
+                for block in pending.popleft().get():
+                    yield block
+        finally:
+            pool.terminate()
+            pool.join()
+
+_block_cipher = None
+
+def _init_block_worker(key):
+    global _block_cipher
+    _block_cipher = RSA(key)
+
+def _block_task(method, blocks):
+    """
+    process pool task, apply RSA method to a chunk of blocks
+    """
+    f = getattr(_block_cipher, method)
+    return [f(block) for block in blocks]
+
+def iter_blocks(source, size):
+    """
+    split readable binary file or iterator of bytes into blocks of `size`
+    bytes, the last block may be shorter
+    """
+    if hasattr(source, 'read'):
+        f = source
+        source = iter(lambda: f.read(size * 64), b'')
+
+    buf = b''
+    for chunk in source:
+        buf += ensure_bytes(chunk)
+        n = len(buf) - len(buf) % size
+        for i in range(0, n, size):
+            yield buf[i:i+size]
+        buf = buf[n:]
+    if buf:
+        yield buf
+
+def write_stream(dest, stream):
+    n = 0
+    for data in stream:
+        dest.write(data)
+        n += len(data)
+    return n
 
 def random_str(l):
-    import os
-    return Bytes(bytearray(0x20 + i % (0x7f - 0x20) for i in bytearray(os.urandom(l))))
+    return Bytes(bytearray(0x20 + i % (0x7f - 0x20) for i in bytearray(randomness.random_bytes(l))))
 
 if __name__ == '__main__':
     import sys
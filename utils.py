@@ -1,14 +1,16 @@
 __all__ = [
     'pyversion',
-    'egcd', 'modinv',
+    'egcd', 'gcd', 'modinv', 'lcm', 'isqrt',
     'Str', 'Bytes', 'IntTypes',
     'bytes2int', 'int2bytes',
     'ensure_bytes', 'ensure_str',
     'profile',
-    'enhex', 'unhex'
+    'enhex', 'unhex',
+    'atomic_write', 'private_dir'
 ]
 
 import binascii
+import os
 import sys
 import time
 
@@ -35,6 +37,11 @@ except:
 
 assert sys.version_info.major == pyversion
 
+try:
+    from math import gcd
+except ImportError: # python2
+    from fractions import gcd
+
 def ensure_bytes(s):
     if type(s) is Str:
         return s.encode('utf-8')
@@ -68,6 +75,24 @@ def modinv(a, m):
         raise ValueError
     return x % m
 
+def lcm(a, b):
+    return a // egcd(a, b)[0] * b
+
+def isqrt(n):
+    """
+    floor of square root of n
+    """
+    if n < 0:
+        raise ValueError('square root of negative number')
+    if n == 0:
+        return 0
+    x = 1 << ((n.bit_length() + 1) >> 1)
+    while True:
+        y = (x + n // x) >> 1
+        if y >= x:
+            return x
+        x = y
+
 def profile(f, args=None):
     t = time.time()
     if not args:
@@ -82,6 +107,35 @@ def enhex(s):
 def unhex(s):
     return binascii.unhexlify(s)
 
+def atomic_write(path, data, mode=0o600):
+    """
+    write data to a temporary file and rename it to path, readers never see
+    a partially written file. the file is created with `mode`, only readable
+    by owner by default
+    """
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        os.remove(tmp) # left by a crashed process with the same pid
+    except OSError:
+        pass
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(ensure_bytes(data))
+    os.rename(tmp, path)
+
+def private_dir(path):
+    """
+    create directory path (and parents) only accessible by owner, an existing
+    directory is restricted too
+    """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    os.chmod(path, 0o700)
+    return path
+
 if __name__ == '__main__':
     print('[*] testing modinv')
     n = 32341